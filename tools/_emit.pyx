@@ -0,0 +1,64 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled emit_all() for generate_tests.py.
+Build in place with: cythonize -i tools/_emit.pyx
+"""
+
+from cpython.number cimport PyIndex_Check
+
+cdef enum:
+    BUF_SIZE = 65536
+
+cpdef bytes emit_all(ops, const unsigned char[:] sizes,
+                     const unsigned char[:] is_addr):
+    """
+    Encode (opcode, rd, rs, imm) tuples. sizes and is_addr are indexed by
+    opcode and give the instruction size and whether imm is an address.
+    """
+    cdef unsigned char buf[BUF_SIZE]
+    cdef Py_ssize_t n = 0
+    cdef long long op, rd, rs, imm
+    cdef unsigned int size
+    cdef unsigned char rb
+
+    for t in ops:
+        if len(t) != 4:
+            raise ValueError(f"bad instruction {t!r}")
+        f0, f1, f2, f3 = t
+        # C conversion truncates floats; reject non-integers like
+        # operator.index() does
+        if not (PyIndex_Check(f0) and PyIndex_Check(f1)
+                and PyIndex_Check(f2) and PyIndex_Check(f3)):
+            raise TypeError(f"bad instruction {t!r}")
+        try:
+            op = f0
+            rd = f1
+            rs = f2
+            imm = f3
+        except OverflowError:
+            raise ValueError(f"bad instruction {t!r}") from None
+        if not (0 <= op <= 0xFF and 0 <= rd <= 7 and 0 <= rs <= 7
+                and 0 <= imm <= 0xFFFF):
+            raise ValueError(f"bad instruction {t!r}")
+        size = sizes[op]
+        if size == 3 and not is_addr[op] and imm > 0xFF:
+            raise ValueError(f"bad instruction {t!r}")
+        if n + size > BUF_SIZE:
+            raise ValueError(f"program exceeds {BUF_SIZE} bytes")
+        rb = (rd << 5) | (rs << 2)
+        buf[n] = <unsigned char>op
+        if size == 2:
+            buf[n + 1] = rb
+        elif size == 3:
+            if is_addr[op]:
+                buf[n + 1] = imm & 0xFF
+                buf[n + 2] = imm >> 8
+            else:
+                buf[n + 1] = rb
+                buf[n + 2] = <unsigned char>imm
+        elif size == 4:
+            buf[n + 1] = rb
+            buf[n + 2] = imm & 0xFF
+            buf[n + 3] = imm >> 8
+        n += size
+    return buf[:n]
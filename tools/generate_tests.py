@@ -4,507 +4,650 @@ Simple script to generate test binary programs for HackVM.
 These are hand-assembled examples until we have a proper assembler.
 """
 
+import array
+import mmap
+import operator
 import struct
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from enum import IntEnum
 
 # Opcode definitions (from opcodes.zig)
-NOP     = 0x00
-HALT    = 0x01
-DISPLAY = 0x02
-RET     = 0x03
-PUSHF   = 0x04
-POPF    = 0x05
-
-MOV     = 0x10
-MOVI    = 0x11
-LOAD    = 0x12
-LOADB   = 0x13
-STORE   = 0x14
-STOREB  = 0x15
-PUSH    = 0x16
-POP     = 0x17
-
-ADD     = 0x20
-ADDI    = 0x21
-SUB     = 0x22
-SUBI    = 0x23
-MUL     = 0x24
-DIV     = 0x25
-INC     = 0x26
-DEC     = 0x27
-NEG     = 0x28
-
-AND     = 0x30
-ANDI    = 0x31
-OR      = 0x32
-ORI     = 0x33
-XOR     = 0x34
-XORI    = 0x35
-NOT     = 0x36
-SHL     = 0x37
-SHLI    = 0x38
-SHR     = 0x39
-SHRI    = 0x3A
-SAR     = 0x3B
-SARI    = 0x3C
-
-CMP     = 0x40
-CMPI    = 0x41
-TEST    = 0x42
-TESTI   = 0x43
-
-JMP     = 0x50
-JMPR    = 0x51
-JZ      = 0x52
-JNZ     = 0x53
-JC      = 0x54
-JNC     = 0x55
-JN      = 0x56
-JNN     = 0x57
-JO      = 0x58
-JNO     = 0x59
-JA      = 0x5A
-JBE     = 0x5B
-JG      = 0x5C
-JGE     = 0x5D
-JL      = 0x5E
-JLE     = 0x5F
-CALL    = 0x60
-CALLR   = 0x61
-
-MEMCPY  = 0x70
-MEMSET  = 0x71
+class Op(IntEnum):
+    NOP     = 0x00
+    HALT    = 0x01
+    DISPLAY = 0x02
+    RET     = 0x03
+    PUSHF   = 0x04
+    POPF    = 0x05
+    PUTC    = 0x06
+    PUTS    = 0x07
+    PUTI    = 0x08
+    PUTX    = 0x09
+    GETC    = 0x0A
+    GETS    = 0x0B
+    KBHIT   = 0x0C
+
+    MOV     = 0x10
+    MOVI    = 0x11
+    LOAD    = 0x12
+    LOADB   = 0x13
+    STORE   = 0x14
+    STOREB  = 0x15
+    PUSH    = 0x16
+    POP     = 0x17
+
+    ADD     = 0x20
+    ADDI    = 0x21
+    SUB     = 0x22
+    SUBI    = 0x23
+    MUL     = 0x24
+    DIV     = 0x25
+    INC     = 0x26
+    DEC     = 0x27
+    NEG     = 0x28
+
+    AND     = 0x30
+    ANDI    = 0x31
+    OR      = 0x32
+    ORI     = 0x33
+    XOR     = 0x34
+    XORI    = 0x35
+    NOT     = 0x36
+    SHL     = 0x37
+    SHLI    = 0x38
+    SHR     = 0x39
+    SHRI    = 0x3A
+    SAR     = 0x3B
+    SARI    = 0x3C
+
+    CMP     = 0x40
+    CMPI    = 0x41
+    TEST    = 0x42
+    TESTI   = 0x43
+
+    JMP     = 0x50
+    JMPR    = 0x51
+    JZ      = 0x52
+    JNZ     = 0x53
+    JC      = 0x54
+    JNC     = 0x55
+    JN      = 0x56
+    JNN     = 0x57
+    JO      = 0x58
+    JNO     = 0x59
+    JA      = 0x5A
+    JBE     = 0x5B
+    JG      = 0x5C
+    JGE     = 0x5D
+    JL      = 0x5E
+    JLE     = 0x5F
+    CALL    = 0x60
+    CALLR   = 0x61
+
+    MEMCPY  = 0x70
+    MEMSET  = 0x71
+
+# Instruction sizes in bytes (from opcodes.zig), indexed by opcode
+OPCODE_SIZE = array.array('B', [1] * 256)
+for _ops, _size in (
+    ((Op.PUTC, Op.PUTS, Op.PUTI, Op.PUTX, Op.GETC, Op.GETS, Op.KBHIT,
+      Op.MOV, Op.LOAD, Op.LOADB, Op.STORE, Op.STOREB, Op.PUSH, Op.POP,
+      Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.INC, Op.DEC, Op.NEG,
+      Op.AND, Op.OR, Op.XOR, Op.NOT, Op.SHL, Op.SHLI, Op.SHR, Op.SHRI,
+      Op.SAR, Op.SARI, Op.CMP, Op.TEST, Op.JMPR, Op.CALLR), 2),
+    ((Op.ADDI, Op.SUBI, Op.ANDI, Op.ORI, Op.XORI, Op.CMPI, Op.TESTI,
+      Op.JMP, Op.JZ, Op.JNZ, Op.JC, Op.JNC, Op.JN, Op.JNN, Op.JO, Op.JNO,
+      Op.JA, Op.JBE, Op.JG, Op.JGE, Op.JL, Op.JLE, Op.CALL), 3),
+    ((Op.MOVI,), 4),
+):
+    for _op in _ops:
+        OPCODE_SIZE[_op] = _size
+del _ops, _size, _op
+
+# Instructions whose operand is an absolute 16-bit address
+ADDR_OPS = frozenset([Op.JMP, Op.CALL] + list(range(Op.JZ, Op.JLE + 1)))
+
+# Program memory is 0x0000-0x3FFF, so no program can be larger than this
+MAX_PROGRAM = 0x4000
+
+# Buffer size for write_program's output file
+WRITE_BUFFER = 65536
+
+# Instruction encoders, one per encoding form
+_OP    = struct.Struct('<B')    # opcode
+_REG   = struct.Struct('<BB')   # opcode, reg byte
+_IMM8  = struct.Struct('<BBB')  # opcode, reg byte, imm8
+_MOVI  = struct.Struct('<BBH')  # opcode, reg byte, imm16
+_JMP   = struct.Struct('<BH')   # opcode, addr16
+_ADDR  = struct.Struct('<H')    # addr16, for patching jump targets
+_IMM16 = struct.Struct('<H')    # imm16, for patching MOVI operands
+
+# Bound pack_into methods used by the Emitter's per-instruction paths
+_pack_op   = _OP.pack_into
+_pack_reg  = _REG.pack_into
+_pack_imm8 = _IMM8.pack_into
+_pack_movi = _MOVI.pack_into
+_MOVI_OPCODE = Op.MOVI.value
+
+def _same_contents(filename, data):
+    """Return True if filename exists and holds exactly data."""
+    try:
+        if os.path.getsize(filename) != len(data):
+            return False
+        with open(filename, 'rb') as f:
+            return f.read() == data
+    except OSError:
+        return False
 
 def write_program(filename, bytecode):
-    """Write bytecode to a binary file."""
-    with open(filename, 'wb') as f:
-        f.write(bytes(bytecode))
-    print(f"Wrote {len(bytecode)} bytes to {filename}")
+    """
+    Write bytecode to a binary file and return a report line. An existing
+    file with identical contents is left alone so its mtime is kept.
+    """
+    if _same_contents(filename, bytecode):
+        return f"Unchanged {len(bytecode)} bytes in {filename}"
+    # BufferedWriter hands writes larger than its buffer straight to the
+    # raw file, so only small writes are coalesced.
+    with open(filename, 'wb', buffering=WRITE_BUFFER) as f:
+        f.write(bytecode)
+    return f"Wrote {len(bytecode)} bytes to {filename}"
+
+def map_program(filename, make):
+    """
+    Run generator make(e) with an Emitter writing straight into a memory
+    mapping of a temporary file, then trim it to the emitted size and move
+    it over filename. If filename already holds the same program, or
+    generation fails, the temporary file is removed and filename is left
+    alone. Returns a report line.
+    """
+    tmp = filename + '.tmp'
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, MAX_PROGRAM)
+        with mmap.mmap(fd, MAX_PROGRAM) as mm:
+            with make(Emitter(mm)) as bytecode:
+                size = len(bytecode)
+                unchanged = _same_contents(filename, bytecode)
+            if not unchanged:
+                mm.flush()
+        if not unchanged:
+            os.ftruncate(fd, size)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp)
+        raise
+    os.close(fd)
+    if unchanged:
+        os.unlink(tmp)
+        return f"Unchanged {size} bytes in {filename}"
+    os.replace(tmp, filename)
+    return f"Wrote {size} bytes to {filename}"
+
+# Register byte [Rd:3][Rs:3][xx:2] for every (rd, rs) pair, indexed by
+# (rd << 3) | rs
+REG_BYTE = bytes([((d & 0x07) << 5) | ((s & 0x07) << 2)
+                  for d in range(8) for s in range(8)])
+
+# Nonzero for opcodes whose 16-bit operand is an address rather than
+# following a register byte
+_IS_ADDR_OP = bytes(op in ADDR_OPS for op in range(256))
+
+# Largest program emit_all() produces (the size of _emit.pyx's buffer)
+EMIT_ALL_MAX = 65536
+
+def _emit_all_py(ops, sizes, is_addr):
+    """
+    Pure-Python emit_all(), used when the _emit extension isn't built.
+    tools/_emit.pyx implements the same checks with C integers.
+    """
+    code = bytearray()
+    for t in ops:
+        if len(t) != 4:
+            raise ValueError(f"bad instruction {t!r}")
+        # index() rejects non-integers, like the C conversion does
+        op, rd, rs, imm = map(operator.index, t)
+        if not (0 <= op <= 0xFF and 0 <= rd <= 7 and 0 <= rs <= 7
+                and 0 <= imm <= 0xFFFF):
+            raise ValueError(f"bad instruction {t!r}")
+        size = sizes[op]
+        if size == 3 and not is_addr[op] and imm > 0xFF:
+            raise ValueError(f"bad instruction {t!r}")
+        if len(code) + size > EMIT_ALL_MAX:
+            raise ValueError(f"program exceeds {EMIT_ALL_MAX} bytes")
+        rb = REG_BYTE[(rd << 3) | rs]
+        if size == 1:
+            code.append(op)
+        elif size == 2:
+            code += _REG.pack(op, rb)
+        elif is_addr[op]:
+            code += _JMP.pack(op, imm)
+        elif size == 3:
+            code += _IMM8.pack(op, rb, imm)
+        else:
+            code += _MOVI.pack(op, rb, imm)
+    return bytes(code)
+
+# Compiled version from tools/_emit.pyx (cythonize -i tools/_emit.pyx)
+try:
+    from _emit import emit_all as _emit_all_impl
+except ImportError:
+    _emit_all_impl = _emit_all_py
+
+def emit_all(ops):
+    """
+    Encode a list of (opcode, rd, rs, imm) tuples and return the bytes.
+    Jump and call operands are absolute addresses taken from imm. Raises
+    ValueError for registers outside 0-7 or an out-of-range immediate, and
+    TypeError for non-integer fields.
+    Used for the label-free fragments below; the compiled version pays off
+    for large label-free instruction streams such as bulk-generated suites.
+    """
+    return _emit_all_impl(ops, OPCODE_SIZE, _IS_ADDR_OP)
+
+# Pre-encoded fragments shared by several programs
+_SCREEN_FILL_HEAD = emit_all([
+    (Op.MOVI, 0, 0, 0x4000),    # R0 = VRAM
+])
+_SCREEN_FILL_TAIL = emit_all([
+    (Op.MOVI, 2, 0, 16384),     # R2 = screen size
+    (Op.MEMSET, 0, 0, 0),
+])
+
+# Fill the screen with an immediate color; patched by clear_screen()
+_CLEAR_SCREEN = (_SCREEN_FILL_HEAD
+                 + emit_all([(Op.MOVI, 1, 0, 0)])
+                 + _SCREEN_FILL_TAIL)
+_CLEAR_SCREEN_COLOR = len(_SCREEN_FILL_HEAD) + 2  # offset of the color imm16
+
+# Fill the screen with the color held in R7
+_FILL_SCREEN_R7 = (_SCREEN_FILL_HEAD
+                   + emit_all([(Op.MOV, 1, 7, 0)])
+                   + _SCREEN_FILL_TAIL)
+
+_DISPLAY_HALT = emit_all([(Op.DISPLAY, 0, 0, 0), (Op.HALT, 0, 0, 0)])
+
+def clear_screen(color):
+    """Return the fill-screen sequence for a constant color."""
+    code = bytearray(_CLEAR_SCREEN)
+    _IMM16.pack_into(code, _CLEAR_SCREEN_COLOR, color)
+    return code
+
+class Emitter:
+    """
+    Packs instructions into a preallocated buffer.
+    Jumps may target labels that are defined later; their addresses are
+    filled in by finalize().
+    """
+    __slots__ = ('buf', 'pos', 'labels', 'fixups')
+
+    def __init__(self, buf=None):
+        # Any writable buffer works (e.g. an mmap); only the default
+        # bytearray can grow.
+        self.buf = bytearray(4096) if buf is None else buf
+        self.pos = 0
+        self.labels = {}
+        self.fixups = []
+
+    def _reserve(self, n):
+        """Grow the buffer so n more bytes fit at the current position."""
+        if self.pos + n > len(self.buf):
+            if not isinstance(self.buf, bytearray):
+                raise ValueError(f"program exceeds {len(self.buf)} byte buffer")
+            self.buf.extend(bytes(max(len(self.buf), n)))
+
+    def emit(self, packer, *args):
+        """Pack one instruction at the current position."""
+        self._reserve(packer.size)
+        packer.pack_into(self.buf, self.pos, *args)
+        self.pos += packer.size
 
-def reg_byte(rd, rs=0):
-    """Encode register byte: [Rd:3][Rs:3][xx:2]"""
-    return ((rd & 0x07) << 5) | ((rs & 0x07) << 2)
+    def raw(self, code):
+        """Copy a pre-encoded instruction sequence to the current position."""
+        n = len(code)
+        self._reserve(n)
+        self.buf[self.pos:self.pos + n] = code
+        self.pos += n
 
-def imm16_le(val):
-    """Return 16-bit value as little-endian bytes."""
-    return [val & 0xFF, (val >> 8) & 0xFF]
+    # The per-form emitters below inline emit() and the register encoding:
+    # they run once per instruction, so they avoid extra Python calls.
+    # (rd | rs) >> 3 is nonzero for any register outside 0-7, negative
+    # ones included.
+
+    def op(self, opcode):
+        self._reserve(1)
+        _pack_op(self.buf, self.pos, opcode)
+        self.pos += 1
+
+    def reg(self, opcode, rd, rs=0):
+        if (rd | rs) >> 3:
+            raise ValueError(f"bad register: rd={rd}, rs={rs}")
+        self._reserve(2)
+        _pack_reg(self.buf, self.pos, opcode, REG_BYTE[(rd << 3) | rs])
+        self.pos += 2
+
+    def imm8(self, opcode, rd, imm):
+        if rd >> 3:
+            raise ValueError(f"bad register: rd={rd}")
+        self._reserve(3)
+        _pack_imm8(self.buf, self.pos, opcode, REG_BYTE[rd << 3], imm)
+        self.pos += 3
+
+    def movi(self, rd, imm):
+        if rd >> 3:
+            raise ValueError(f"bad register: rd={rd}")
+        self._reserve(4)
+        _pack_movi(self.buf, self.pos, _MOVI_OPCODE, REG_BYTE[rd << 3], imm)
+        self.pos += 4
+
+    def jmp(self, opcode, label):
+        """Emit a jump/call to label, resolved at finalize()."""
+        self.fixups.append((self.pos + 1, label))
+        self.emit(_JMP, opcode, 0)
+
+    def label(self, name):
+        """Bind name to the current address."""
+        self.labels[name] = self.pos
+
+    def patch(self, addr, target):
+        """Overwrite the 16-bit address operand at addr."""
+        _ADDR.pack_into(self.buf, addr, target)
+
+    def finalize(self):
+        """
+        Resolve all jump targets, run the peephole optimizer and return a
+        memoryview of the program. Release the view before closing a mapped
+        buffer.
+        """
+        for addr, label in self.fixups:
+            self.patch(addr, self.labels[label])
+        self.fixups.clear()
+        self.pos = peephole(self.buf, self.pos)
+        return memoryview(self.buf)[:self.pos]
+
+# =============================================================================
+# Peephole optimizer
+# =============================================================================
+# Opcodes that write no register and leave the known-register state intact
+_NO_REG_WRITE = frozenset([
+    Op.NOP, Op.DISPLAY, Op.PUSHF, Op.POPF, Op.STORE, Op.STOREB, Op.PUSH,
+    Op.CMP, Op.CMPI, Op.TEST, Op.TESTI, Op.PUTC, Op.PUTS, Op.PUTI, Op.PUTX,
+] + list(range(Op.JZ, Op.JLE + 1)))
+
+# Opcodes after which the next instruction is only reachable by a jump,
+# or which may change any register
+_BLOCK_END = frozenset([Op.HALT, Op.RET, Op.JMP, Op.JMPR, Op.CALL, Op.CALLR])
+
+# Opcodes that overwrite every flag without reading any
+_SETS_ALL_FLAGS = frozenset([Op.ADD, Op.ADDI, Op.SUB, Op.SUBI, Op.CMP, Op.CMPI])
+
+def peephole(buf, size):
+    """
+    Remove redundant instructions from buf[:size] in place and return the
+    new size. Tracks registers holding known constants within each basic
+    block and drops:
+      - MOVI Rx, c        when Rx already holds c
+      - PUSH Rx; POP Rx
+      - ADD Ry, Rx        when Rx holds 0 and the next instruction
+                          overwrites all flags
+    Jump targets are relocated. Code that cannot be fully decoded, or that
+    uses JMPR/CALLR (whose register targets can't be found or relocated),
+    is left untouched.
+    """
+    (MOV, MOVI, PUSH, POP, ADD, DIV, JMPR, CALLR, MEMCPY, MEMSET) = (
+        Op.MOV.value, Op.MOVI.value, Op.PUSH.value, Op.POP.value,
+        Op.ADD.value, Op.DIV.value, Op.JMPR.value, Op.CALLR.value,
+        Op.MEMCPY.value, Op.MEMSET.value)
+    
+    # Decode instruction boundaries and jump targets
+    starts = []
+    targets = set()
+    pc = 0
+    while pc < size:
+        op = buf[pc]
+        if op == JMPR or op == CALLR:
+            return size
+        starts.append(pc)
+        if op in ADDR_OPS:
+            targets.add(_ADDR.unpack_from(buf, pc + 1)[0])
+        pc += OPCODE_SIZE[op]
+    if pc != size or not targets <= set(starts):
+        return size
+    
+    drop = set()
+    known = [None] * 8
+    for i, pc in enumerate(starts):
+        if pc in targets:
+            known = [None] * 8
+        if pc in drop:
+            continue
+        op = buf[pc]
+        rd = buf[pc + 1] >> 5 if OPCODE_SIZE[op] > 1 else None
+        rs = (buf[pc + 1] >> 2) & 0x07 if rd is not None else None
+        nxt = starts[i + 1] if i + 1 < len(starts) else None
+        
+        if op == MOVI:
+            imm = _ADDR.unpack_from(buf, pc + 2)[0]
+            if known[rd] == imm:
+                drop.add(pc)
+            known[rd] = imm
+        elif op == MOV:
+            known[rd] = known[rs]
+        elif op == PUSH:
+            if (nxt is not None and nxt not in targets and buf[nxt] == POP
+                    and buf[nxt + 1] >> 5 == rs):
+                drop.update((pc, nxt))
+        elif op == ADD:
+            if (known[rs] == 0 and nxt is not None
+                    and buf[nxt] in _SETS_ALL_FLAGS):
+                drop.add(pc)
+            else:
+                known[rd] = None
+        elif op == DIV:  # remainder goes to R0
+            known[rd] = known[0] = None
+        elif op in (MEMSET, MEMCPY):
+            known[0] = known[1] = None
+            known[2] = 0
+        elif op in _BLOCK_END:
+            known = [None] * 8
+        elif op not in _NO_REG_WRITE:
+            if rd is None:
+                known = [None] * 8
+            else:
+                known[rd] = None
+    
+    if not drop:
+        return size
+    
+    # Map every old address to its new one, then compact. Instructions only
+    # ever move down, so reading ahead of the write position is safe.
+    new_addr = {}
+    out = 0
+    for pc in starts:
+        new_addr[pc] = out
+        if pc not in drop:
+            out += OPCODE_SIZE[buf[pc]]
+    new_addr[size] = out
+    
+    for pc in starts:
+        if pc in drop:
+            continue
+        op = buf[pc]
+        n = OPCODE_SIZE[op]
+        dst = new_addr[pc]
+        buf[dst:dst + n] = buf[pc:pc + n]
+        if op in ADDR_OPS:
+            _ADDR.pack_into(buf, dst + 1,
+                            new_addr[_ADDR.unpack_from(buf, dst + 1)[0]])
+    return out
 
 # =============================================================================
 # Test Program 1: Fill screen with red
 # =============================================================================
-def make_fill_red():
-    code = []
-    
-    # MOVI R0, 0x4000
-    code.append(MOVI)
-    code.append(reg_byte(0, 0))
-    code.extend(imm16_le(0x4000))
+def make_fill_red(e=None):
+    e = Emitter() if e is None else e
     
-    # MOVI R1, 0xE0 (red)
-    code.append(MOVI)
-    code.append(reg_byte(1, 0))
-    code.extend(imm16_le(0x00E0))
+    e.raw(clear_screen(0xE0))   # red
+    e.raw(_DISPLAY_HALT)
     
-    # MOVI R2, 16384
-    code.append(MOVI)
-    code.append(reg_byte(2, 0))
-    code.extend(imm16_le(16384))
-    
-    # MEMSET
-    code.append(MEMSET)
-    
-    # DISPLAY
-    code.append(DISPLAY)
-    
-    # HALT
-    code.append(HALT)
-    
-    return code
+    return e.finalize()
 
 # =============================================================================
 # Test Program 2: Color gradient
 # =============================================================================
-def make_gradient():
-    code = []
-    
-    # MOVI R4, 0x4000
-    code.append(MOVI)
-    code.append(reg_byte(4, 0))
-    code.extend(imm16_le(0x4000))
-    
-    # MOVI R5, 0
-    code.append(MOVI)
-    code.append(reg_byte(5, 0))
-    code.extend(imm16_le(0))
-    
-    # MOVI R6, 128
-    code.append(MOVI)
-    code.append(reg_byte(6, 0))
-    code.extend(imm16_le(128))
-    
-    row_loop = len(code)
-    
-    # MOV R0, R4
-    code.append(MOV)
-    code.append(reg_byte(0, 4))
-    
-    # MOV R1, R5
-    code.append(MOV)
-    code.append(reg_byte(1, 5))
-    
-    # MOVI R2, 128
-    code.append(MOVI)
-    code.append(reg_byte(2, 0))
-    code.extend(imm16_le(128))
-    
-    # MEMSET
-    code.append(MEMSET)
-    
-    # MOVI R3, 128
-    code.append(MOVI)
-    code.append(reg_byte(3, 0))
-    code.extend(imm16_le(128))
-    
-    # ADD R4, R3
-    code.append(ADD)
-    code.append(reg_byte(4, 3))
-    
-    # INC R5
-    code.append(INC)
-    code.append(reg_byte(5, 0))
-    
-    # DEC R6
-    code.append(DEC)
-    code.append(reg_byte(6, 0))
-    
-    # JNZ row_loop
-    code.append(JNZ)
-    code.extend(imm16_le(row_loop))
-    
-    # DISPLAY
-    code.append(DISPLAY)
-    
-    # HALT
-    code.append(HALT)
-    
-    return code
+def make_gradient(e=None):
+    e = Emitter() if e is None else e
+    (HALT, DISPLAY, MOV, ADD, INC, DEC, JNZ, MEMSET) = (
+        Op.HALT.value, Op.DISPLAY.value, Op.MOV.value, Op.ADD.value,
+        Op.INC.value, Op.DEC.value, Op.JNZ.value, Op.MEMSET.value)
+    
+    e.movi(4, 0x4000)   # R4 = row pointer
+    e.movi(5, 0)        # R5 = row color
+    e.movi(6, 128)      # R6 = rows remaining
+    
+    e.label('row_loop')
+    e.reg(MOV, 0, 4)    # R0 = row pointer
+    e.reg(MOV, 1, 5)    # R1 = color
+    e.movi(2, 128)      # R2 = row width
+    e.op(MEMSET)
+    e.movi(3, 128)
+    e.reg(ADD, 4, 3)    # next row
+    e.reg(INC, 5)
+    e.reg(DEC, 6)
+    e.jmp(JNZ, 'row_loop')
+    
+    e.op(DISPLAY)
+    e.op(HALT)
+    
+    return e.finalize()
 
 # =============================================================================
 # Test Program 3: Animated color cycle
 # =============================================================================
-def make_color_cycle():
-    code = []
-    
-    # MOVI R7, 0
-    code.append(MOVI)
-    code.append(reg_byte(7, 0))
-    code.extend(imm16_le(0))
-    
-    frame_loop = len(code)
-    
-    # MOVI R0, 0x4000
-    code.append(MOVI)
-    code.append(reg_byte(0, 0))
-    code.extend(imm16_le(0x4000))
-    
-    # MOV R1, R7
-    code.append(MOV)
-    code.append(reg_byte(1, 7))
-    
-    # MOVI R2, 16384
-    code.append(MOVI)
-    code.append(reg_byte(2, 0))
-    code.extend(imm16_le(16384))
-    
-    # MEMSET
-    code.append(MEMSET)
-    
-    # DISPLAY
-    code.append(DISPLAY)
+def make_color_cycle(e=None):
+    e = Emitter() if e is None else e
+    DISPLAY, INC, JMP = Op.DISPLAY.value, Op.INC.value, Op.JMP.value
     
-    # INC R7
-    code.append(INC)
-    code.append(reg_byte(7, 0))
+    e.movi(7, 0)        # R7 = current color
     
-    # JMP frame_loop
-    code.append(JMP)
-    code.extend(imm16_le(frame_loop))
+    e.label('frame_loop')
+    e.raw(_FILL_SCREEN_R7)
+    e.op(DISPLAY)
+    e.reg(INC, 7)
+    e.jmp(JMP, 'frame_loop')
     
-    return code
+    return e.finalize()
 
 # =============================================================================
 # Test Program 4: Keyboard test - change color on keypress
 # =============================================================================
-def make_keyboard_test():
-    code = []
-    
-    frame_loop = 0
-    
-    # MOVI R0, 0xFFF5 (KEY_STATE)
-    code.append(MOVI)
-    code.append(reg_byte(0, 0))
-    code.extend(imm16_le(0xFFF5))
-    
-    # LOADB R1, [R0]
-    code.append(LOADB)
-    code.append(reg_byte(1, 0))
-    
-    # CMPI R1, 0
-    code.append(CMPI)
-    code.append(reg_byte(1, 0))
-    code.append(0)
-    
-    # JZ no_key
-    jz_addr = len(code)
-    code.append(JZ)
-    code.extend(imm16_le(0))  # Placeholder
-    
-    # MOVI R0, 0xFFF4 (KEY_CODE)
-    code.append(MOVI)
-    code.append(reg_byte(0, 0))
-    code.extend(imm16_le(0xFFF4))
-    
-    # LOADB R7, [R0]
-    code.append(LOADB)
-    code.append(reg_byte(7, 0))
-    
-    no_key = len(code)
-    
-    # Patch JZ target
-    code[jz_addr + 1] = no_key & 0xFF
-    code[jz_addr + 2] = (no_key >> 8) & 0xFF
-    
-    # MOVI R0, 0x4000
-    code.append(MOVI)
-    code.append(reg_byte(0, 0))
-    code.extend(imm16_le(0x4000))
-    
-    # MOV R1, R7
-    code.append(MOV)
-    code.append(reg_byte(1, 7))
-    
-    # MOVI R2, 16384
-    code.append(MOVI)
-    code.append(reg_byte(2, 0))
-    code.extend(imm16_le(16384))
-    
-    # MEMSET
-    code.append(MEMSET)
-    
-    # DISPLAY
-    code.append(DISPLAY)
-    
-    # JMP frame_loop
-    code.append(JMP)
-    code.extend(imm16_le(frame_loop))
-    
-    return code
+def make_keyboard_test(e=None):
+    e = Emitter() if e is None else e
+    (DISPLAY, LOADB, CMPI, JMP, JZ) = (
+        Op.DISPLAY.value, Op.LOADB.value, Op.CMPI.value, Op.JMP.value,
+        Op.JZ.value)
+    
+    e.label('frame_loop')
+    e.movi(0, 0xFFF5)       # KEY_STATE
+    e.reg(LOADB, 1, 0)
+    e.imm8(CMPI, 1, 0)
+    e.jmp(JZ, 'no_key')
+    
+    e.movi(0, 0xFFF4)       # KEY_CODE
+    e.reg(LOADB, 7, 0)      # R7 = color from key code
+    
+    e.label('no_key')
+    e.raw(_FILL_SCREEN_R7)
+    e.op(DISPLAY)
+    e.jmp(JMP, 'frame_loop')
+    
+    return e.finalize()
 
 # =============================================================================
 # Test Program 5: Moving pixel with arrow keys
 # =============================================================================
-def make_moving_pixel():
-    code = []
+# Key code -> (opcode, register) applied to the pixel position
+ARROW_KEYS = (
+    (0x80, Op.DEC, 5),  # UP:    Y--
+    (0x81, Op.INC, 5),  # DOWN:  Y++
+    (0x82, Op.DEC, 4),  # LEFT:  X--
+    (0x83, Op.INC, 4),  # RIGHT: X++
+)
+
+def make_moving_pixel(e=None):
+    e = Emitter() if e is None else e
+    (DISPLAY, MOV, LOADB, STOREB, ADD, MUL, ANDI, CMPI, JMP, JZ, JNZ) = (
+        Op.DISPLAY.value, Op.MOV.value, Op.LOADB.value, Op.STOREB.value,
+        Op.ADD.value, Op.MUL.value, Op.ANDI.value, Op.CMPI.value,
+        Op.JMP.value, Op.JZ.value, Op.JNZ.value)
     
     # Initialize position to center
-    # MOVI R4, 64
-    code.append(MOVI)
-    code.append(reg_byte(4, 0))
-    code.extend(imm16_le(64))
-    
-    # MOVI R5, 64
-    code.append(MOVI)
-    code.append(reg_byte(5, 0))
-    code.extend(imm16_le(64))
+    e.movi(4, 64)           # R4 = X
+    e.movi(5, 64)           # R5 = Y
     
-    frame_loop = len(code)
+    e.label('frame_loop')
     
     # === Clear screen ===
-    # MOVI R0, 0x4000
-    code.append(MOVI)
-    code.append(reg_byte(0, 0))
-    code.extend(imm16_le(0x4000))
-    
-    # MOVI R1, 0 (black)
-    code.append(MOVI)
-    code.append(reg_byte(1, 0))
-    code.extend(imm16_le(0))
-    
-    # MOVI R2, 16384
-    code.append(MOVI)
-    code.append(reg_byte(2, 0))
-    code.extend(imm16_le(16384))
-    
-    # MEMSET
-    code.append(MEMSET)
+    e.raw(clear_screen(0x00))  # black
     
     # === Handle input ===
-    # MOVI R0, 0xFFF5 (KEY_STATE)
-    code.append(MOVI)
-    code.append(reg_byte(0, 0))
-    code.extend(imm16_le(0xFFF5))
-    
-    # LOADB R1, [R0]
-    code.append(LOADB)
-    code.append(reg_byte(1, 0))
-    
-    # CMPI R1, 0
-    code.append(CMPI)
-    code.append(reg_byte(1, 0))
-    code.append(0)
-    
-    # JZ draw_pixel
-    jz_to_draw = len(code)
-    code.append(JZ)
-    code.extend(imm16_le(0))  # Placeholder
+    e.movi(0, 0xFFF5)       # KEY_STATE
+    e.reg(LOADB, 1, 0)
+    e.imm8(CMPI, 1, 0)
+    e.jmp(JZ, 'draw_pixel')
     
     # Read key code
-    # MOVI R0, 0xFFF4
-    code.append(MOVI)
-    code.append(reg_byte(0, 0))
-    code.extend(imm16_le(0xFFF4))
-    
-    # LOADB R1, [R0]
-    code.append(LOADB)
-    code.append(reg_byte(1, 0))
-    
-    # Check UP (0x80)
-    code.append(CMPI)
-    code.append(reg_byte(1, 0))
-    code.append(0x80)
-    
-    jnz_not_up = len(code)
-    code.append(JNZ)
-    code.extend(imm16_le(0))
-    
-    # DEC R5 (Y--)
-    code.append(DEC)
-    code.append(reg_byte(5, 0))
-    
-    jmp_to_draw1 = len(code)
-    code.append(JMP)
-    code.extend(imm16_le(0))
-    
-    not_up = len(code)
-    code[jnz_not_up + 1] = not_up & 0xFF
-    code[jnz_not_up + 2] = (not_up >> 8) & 0xFF
-    
-    # Check DOWN (0x81)
-    code.append(CMPI)
-    code.append(reg_byte(1, 0))
-    code.append(0x81)
-    
-    jnz_not_down = len(code)
-    code.append(JNZ)
-    code.extend(imm16_le(0))
-    
-    # INC R5 (Y++)
-    code.append(INC)
-    code.append(reg_byte(5, 0))
-    
-    jmp_to_draw2 = len(code)
-    code.append(JMP)
-    code.extend(imm16_le(0))
-    
-    not_down = len(code)
-    code[jnz_not_down + 1] = not_down & 0xFF
-    code[jnz_not_down + 2] = (not_down >> 8) & 0xFF
-    
-    # Check LEFT (0x82)
-    code.append(CMPI)
-    code.append(reg_byte(1, 0))
-    code.append(0x82)
-    
-    jnz_not_left = len(code)
-    code.append(JNZ)
-    code.extend(imm16_le(0))
-    
-    # DEC R4 (X--)
-    code.append(DEC)
-    code.append(reg_byte(4, 0))
-    
-    jmp_to_draw3 = len(code)
-    code.append(JMP)
-    code.extend(imm16_le(0))
-    
-    not_left = len(code)
-    code[jnz_not_left + 1] = not_left & 0xFF
-    code[jnz_not_left + 2] = (not_left >> 8) & 0xFF
-    
-    # Check RIGHT (0x83)
-    code.append(CMPI)
-    code.append(reg_byte(1, 0))
-    code.append(0x83)
-    
-    jnz_draw = len(code)
-    code.append(JNZ)
-    code.extend(imm16_le(0))
-    
-    # INC R4 (X++)
-    code.append(INC)
-    code.append(reg_byte(4, 0))
+    e.movi(0, 0xFFF4)
+    e.reg(LOADB, 1, 0)
+    
+    # Arrow keys: adjust X/Y, then skip the remaining checks
+    last = len(ARROW_KEYS) - 1
+    for i, (key, opcode, rd) in enumerate(ARROW_KEYS):
+        skip = f'not_{key:02x}'
+        e.imm8(CMPI, 1, key)
+        e.jmp(JNZ, skip)
+        e.reg(opcode, rd)
+        if i != last:  # the last check falls through into draw_pixel
+            e.jmp(JMP, 'draw_pixel')
+        e.label(skip)
     
     # === Draw pixel ===
-    draw_pixel = len(code)
-    
-    # Patch all jumps to draw_pixel
-    for addr in [jz_to_draw, jmp_to_draw1, jmp_to_draw2, jmp_to_draw3, jnz_draw]:
-        code[addr + 1] = draw_pixel & 0xFF
-        code[addr + 2] = (draw_pixel >> 8) & 0xFF
+    e.label('draw_pixel')
     
     # Clamp positions with AND 0x7F
-    code.append(ANDI)
-    code.append(reg_byte(4, 0))
-    code.append(0x7F)
-    
-    code.append(ANDI)
-    code.append(reg_byte(5, 0))
-    code.append(0x7F)
+    e.imm8(ANDI, 4, 0x7F)
+    e.imm8(ANDI, 5, 0x7F)
     
     # Calculate pixel address: 0x4000 + Y*128 + X
-    # MOVI R3, 128
-    code.append(MOVI)
-    code.append(reg_byte(3, 0))
-    code.extend(imm16_le(128))
-    
-    # MOV R0, R5
-    code.append(MOV)
-    code.append(reg_byte(0, 5))
-    
-    # MUL R0, R3
-    code.append(MUL)
-    code.append(reg_byte(0, 3))
-    
-    # ADD R0, R4
-    code.append(ADD)
-    code.append(reg_byte(0, 4))
-    
-    # MOVI R3, 0x4000
-    code.append(MOVI)
-    code.append(reg_byte(3, 0))
-    code.extend(imm16_le(0x4000))
-    
-    # ADD R0, R3
-    code.append(ADD)
-    code.append(reg_byte(0, 3))
-    
-    # MOVI R1, 0xFF (white)
-    code.append(MOVI)
-    code.append(reg_byte(1, 0))
-    code.extend(imm16_le(0xFF))
-    
-    # STOREB [R0], R1
-    code.append(STOREB)
-    code.append(reg_byte(0, 1))
-    
-    # DISPLAY
-    code.append(DISPLAY)
-    
-    # JMP frame_loop
-    code.append(JMP)
-    code.extend(imm16_le(frame_loop))
-    
-    return code
+    e.movi(3, 128)
+    e.reg(MOV, 0, 5)
+    e.reg(MUL, 0, 3)
+    e.reg(ADD, 0, 4)
+    e.movi(3, 0x4000)
+    e.reg(ADD, 0, 3)
+    
+    e.movi(1, 0xFF)         # white
+    e.reg(STOREB, 0, 1)
+    e.op(DISPLAY)
+    e.jmp(JMP, 'frame_loop')
+    
+    return e.finalize()
+
+
+# Output file name -> generator for every example program
+PROGRAMS = [
+    ('fill_red.bin', make_fill_red),
+    ('gradient.bin', make_gradient),
+    ('color_cycle.bin', make_color_cycle),
+    ('keyboard_test.bin', make_keyboard_test),
+    ('moving_pixel.bin', make_moving_pixel),
+]
+
+def _run(job):
+    """Worker entry point: generate one program into its file."""
+    filename, make = job
+    return map_program(filename, make)
 
 
 if __name__ == '__main__':
@@ -516,12 +659,15 @@ if __name__ == '__main__':
     # Ensure examples directory exists
     os.makedirs(examples_dir, exist_ok=True)
     
-    write_program(os.path.join(examples_dir, 'fill_red.bin'), make_fill_red())
-    write_program(os.path.join(examples_dir, 'gradient.bin'), make_gradient())
-    write_program(os.path.join(examples_dir, 'color_cycle.bin'), make_color_cycle())
-    write_program(os.path.join(examples_dir, 'keyboard_test.bin'), make_keyboard_test())
-    write_program(os.path.join(examples_dir, 'moving_pixel.bin'), make_moving_pixel())
-    
-    print("\nAll test programs generated!")
-    print("Build the emulator with: zig build wasm")
-    print("Then open web/index.html and load a .bin file")
+    jobs = [(os.path.join(examples_dir, name), make) for name, make in PROGRAMS]
+    with ProcessPoolExecutor() as pool:
+        report = list(pool.map(_run, jobs))
+    
+    # Collect all output into a single write
+    report += [
+        "",
+        "All test programs generated!",
+        "Build the emulator with: zig build wasm",
+        "Then open web/index.html and load a .bin file",
+    ]
+    sys.stdout.write('\n'.join(report) + '\n')
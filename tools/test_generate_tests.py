@@ -0,0 +1,327 @@
+"""
+Tests for generate_tests.py.
+Run with: python3 -m unittest discover -s tools
+"""
+
+import os
+import tempfile
+import unittest
+
+from generate_tests import (MAX_PROGRAM, Emitter, Op, OPCODE_SIZE,
+                            _IS_ADDR_OP, _emit_all_py,
+                            make_color_cycle, map_program,
+                            make_fill_red, make_gradient, make_keyboard_test,
+                            make_moving_pixel, write_program)
+
+try:
+    from _emit import emit_all as emit_all_compiled
+except ImportError:
+    emit_all_compiled = None
+
+
+def build(*steps):
+    """Run each step(e) on a fresh Emitter and return the finalized bytes."""
+    e = Emitter()
+    for step in steps:
+        step(e)
+    return bytes(e.finalize())
+
+
+class EmitterTest(unittest.TestCase):
+    def test_rejects_registers_outside_0_to_7(self):
+        for emit in (lambda e: e.reg(Op.MOV, 0, 8),
+                     lambda e: e.reg(Op.MOV, 8, 0),
+                     lambda e: e.reg(Op.MOV, -1, 0),
+                     lambda e: e.imm8(Op.CMPI, 8, 0),
+                     lambda e: e.movi(-1, 0),
+                     lambda e: e.movi(8, 0)):
+            with self.assertRaises(ValueError):
+                emit(Emitter())
+
+    def test_encodes_registers(self):
+        self.assertEqual(build(lambda e: e.reg(Op.MOV, 1, 7),
+                               lambda e: e.reg(Op.MOV, 7, 0)),
+                         bytes([Op.MOV, 0x3C, Op.MOV, 0xE0]))
+
+
+class PeepholeTest(unittest.TestCase):
+    def test_drops_repeated_movi(self):
+        code = build(lambda e: e.movi(3, 5),
+                     lambda e: e.movi(3, 5),
+                     lambda e: e.op(Op.HALT))
+        self.assertEqual(code, bytes([Op.MOVI, 0x60, 0x05, 0x00, Op.HALT]))
+
+    def test_keeps_movi_of_different_value(self):
+        code = build(lambda e: e.movi(3, 5),
+                     lambda e: e.movi(3, 6),
+                     lambda e: e.op(Op.HALT))
+        self.assertEqual(len(code), 9)
+
+    def test_keeps_movi_at_jump_target(self):
+        def steps(e):
+            e.movi(3, 5)
+            e.label('top')
+            e.movi(3, 5)
+            e.reg(Op.INC, 3)
+            e.jmp(Op.JMP, 'top')
+        code = build(steps)
+        self.assertEqual(len(code), 4 + 4 + 2 + 3)
+
+    def test_drops_push_pop_pair(self):
+        code = build(lambda e: e.reg(Op.PUSH, 0, 2),
+                     lambda e: e.reg(Op.POP, 2),
+                     lambda e: e.op(Op.HALT))
+        self.assertEqual(code, bytes([Op.HALT]))
+
+    def test_keeps_push_pop_of_different_registers(self):
+        code = build(lambda e: e.reg(Op.PUSH, 0, 2),
+                     lambda e: e.reg(Op.POP, 3),
+                     lambda e: e.op(Op.HALT))
+        self.assertEqual(len(code), 5)
+
+    def test_drops_add_zero_when_flags_overwritten(self):
+        code = build(lambda e: e.movi(1, 0),
+                     lambda e: e.reg(Op.ADD, 4, 1),
+                     lambda e: e.imm8(Op.CMPI, 4, 1),
+                     lambda e: e.op(Op.HALT))
+        self.assertEqual(code, bytes([Op.MOVI, 0x20, 0x00, 0x00,
+                                      Op.CMPI, 0x80, 0x01, Op.HALT]))
+
+    def test_keeps_add_zero_when_flags_are_read(self):
+        def steps(e):
+            e.movi(1, 0)
+            e.reg(Op.ADD, 4, 1)
+            e.jmp(Op.JZ, 'end')
+            e.label('end')
+            e.op(Op.HALT)
+        code = build(steps)
+        self.assertEqual(len(code), 4 + 2 + 3 + 1)
+
+    def test_retargets_jumps_across_dropped_instruction(self):
+        def steps(e):
+            e.movi(3, 5)
+            e.movi(3, 5)            # dropped
+            e.jmp(Op.JMP, 'end')
+            e.op(Op.NOP)
+            e.label('end')
+            e.op(Op.HALT)
+        code = build(steps)
+        self.assertEqual(code, bytes([Op.MOVI, 0x60, 0x05, 0x00,
+                                      Op.JMP, 0x08, 0x00,
+                                      Op.NOP, Op.HALT]))
+
+    def test_leaves_register_jumps_untouched(self):
+        def steps(e):
+            e.movi(1, 5)
+            e.movi(1, 5)
+            e.movi(2, 16)
+            e.reg(Op.JMPR, 0, 2)
+            e.op(Op.NOP)
+            e.op(Op.NOP)
+            e.op(Op.HALT)
+        code = build(steps)
+        self.assertEqual(len(code), 17)
+        self.assertEqual(code[16], Op.HALT)
+
+
+# One instruction of every encoding form, with its expected bytes
+FORMS = [
+    ((Op.HALT, 0, 0, 0),        bytes([0x01])),
+    ((Op.MOV, 1, 7, 0),         bytes([0x10, 0x3C])),
+    ((Op.SHLI, 2, 5, 0),        bytes([0x38, 0x54])),
+    ((Op.CMPI, 1, 0, 0x80),     bytes([0x41, 0x20, 0x80])),
+    ((Op.ANDI, 4, 3, 0x7F),     bytes([0x31, 0x8C, 0x7F])),
+    ((Op.JNZ, 0, 0, 0x0102),    bytes([0x53, 0x02, 0x01])),
+    ((Op.CALL, 0, 0, 0x1234),   bytes([0x60, 0x34, 0x12])),
+    ((Op.MOVI, 3, 0, 0x1234),   bytes([0x11, 0x60, 0x34, 0x12])),
+    ((Op.MOVI, 1, 2, 7),        bytes([0x11, 0x28, 0x07, 0x00])),
+]
+
+BAD_OPS = [
+    (Op.MOV, 8, 0, 0),          # rd out of range
+    (Op.MOV, -1, 0, 0),
+    (Op.MOV, 0, 8, 0),          # rs out of range
+    (Op.CMPI, 1, 0, 0x100),     # imm8 out of range
+    (Op.MOVI, 1, 0, 0x10000),   # imm16 out of range
+    (Op.MOVI, 1, 0, -1),
+    (0x100, 0, 0, 0),           # opcode out of range
+    (Op.HALT, 0, 0),            # wrong arity
+    (Op.MOVI, 1, 0, 2 ** 70),   # too large for a C integer
+]
+
+# Non-integer fields
+TYPE_ERROR_OPS = [
+    (1.5, 0, 0, 0),
+    (Op.MOVI, 1, 0, 1.0),
+    (Op.MOV, '1', 0, 0),
+]
+
+
+def fallback(ops):
+    return _emit_all_py(ops, OPCODE_SIZE, _IS_ADDR_OP)
+
+
+class EmitAllTest(unittest.TestCase):
+    def test_fallback_encodes_every_form(self):
+        for op, expected in FORMS:
+            with self.subTest(op=op):
+                self.assertEqual(fallback([op]), expected)
+        self.assertEqual(fallback([op for op, _ in FORMS]),
+                         b''.join(expected for _, expected in FORMS))
+
+    def test_fallback_rejects_bad_operands(self):
+        for op in BAD_OPS:
+            with self.subTest(op=op):
+                with self.assertRaises(ValueError):
+                    fallback([op])
+
+    def test_fallback_rejects_non_integers(self):
+        for op in TYPE_ERROR_OPS:
+            with self.subTest(op=op):
+                with self.assertRaises(TypeError):
+                    fallback([op])
+
+    def test_fallback_bulk_encode(self):
+        ops = [op for op, _ in FORMS] * 1000
+        expected = b''.join(expected for _, expected in FORMS) * 1000
+        self.assertEqual(fallback(ops), expected)
+
+    def test_fallback_rejects_oversized_program(self):
+        with self.assertRaises(ValueError):
+            fallback([(Op.MOVI, 0, 0, 0)] * 16385)
+
+    @unittest.skipIf(emit_all_compiled is None, "_emit extension not built")
+    def test_compiled_matches_fallback(self):
+        ops = [op for op, _ in FORMS]
+        self.assertEqual(emit_all_compiled(ops, OPCODE_SIZE, _IS_ADDR_OP),
+                         fallback(ops))
+        for op in BAD_OPS:
+            with self.subTest(op=op):
+                with self.assertRaises(ValueError):
+                    emit_all_compiled([op], OPCODE_SIZE, _IS_ADDR_OP)
+        for op in TYPE_ERROR_OPS:
+            with self.subTest(op=op):
+                with self.assertRaises(TypeError):
+                    emit_all_compiled([op], OPCODE_SIZE, _IS_ADDR_OP)
+        with self.assertRaises(ValueError):
+            emit_all_compiled([(Op.MOVI, 0, 0, 0)] * 16385,
+                              OPCODE_SIZE, _IS_ADDR_OP)
+        bulk = ops * 1000
+        self.assertEqual(emit_all_compiled(bulk, OPCODE_SIZE, _IS_ADDR_OP),
+                         fallback(bulk))
+
+
+
+# Expected bytes of every example program, so encoder and peephole
+# changes can't silently alter them
+GOLDEN = [
+    (make_fill_red,
+        '110000401120e00011400040710201'),
+    (make_gradient,
+        '1180004011a0000011c0800010101034114080007111608000208c26'
+        'a027c0530c000201'),
+    (make_color_cycle,
+        '11e0000011000040103c11400040710226e0500400'),
+    (make_keyboard_test,
+        '1100f5ff13204120005212001100f4ff13e011000040103c11400040'
+        '7102500000'),
+    (make_moving_pixel,
+        '1180400011a04000110000401120000011400040711100f5ff132041'
+        '20005250001100f4ff132041208053320027a0505000412081533d00'
+        '26a05050004120825348002780505000412083535000268031807f31'
+        'a07f116080001014240c201011600040200c1120ff00150402500800'),
+]
+
+
+class GoldenTest(unittest.TestCase):
+    def test_example_programs(self):
+        for make, expected in GOLDEN:
+            with self.subTest(make=make.__name__):
+                self.assertEqual(bytes(make()).hex(), expected)
+
+
+
+class WriteProgramTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'prog.bin')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_creates_missing_file(self):
+        report = write_program(self.path, b'\x01\x02\x03')
+        self.assertTrue(report.startswith("Wrote 3 bytes"))
+        self.assertEqual(self.read(), b'\x01\x02\x03')
+
+    def test_identical_file_keeps_mtime(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x01\x02\x03')
+        os.utime(self.path, ns=(1_000_000_000, 1_000_000_000))
+        report = write_program(self.path, b'\x01\x02\x03')
+        self.assertTrue(report.startswith("Unchanged 3 bytes"))
+        self.assertEqual(os.stat(self.path).st_mtime_ns, 1_000_000_000)
+
+    def test_same_size_different_bytes_rewritten(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x01\x02\x03')
+        os.utime(self.path, ns=(1_000_000_000, 1_000_000_000))
+        report = write_program(self.path, b'\x01\x02\x04')
+        self.assertTrue(report.startswith("Wrote 3 bytes"))
+        self.assertEqual(self.read(), b'\x01\x02\x04')
+        self.assertNotEqual(os.stat(self.path).st_mtime_ns, 1_000_000_000)
+
+
+class MapProgramTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'prog.bin')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_writes_program(self):
+        report = map_program(self.path, make_gradient)
+        self.assertTrue(report.startswith("Wrote 36 bytes"))
+        self.assertEqual(self.read(), bytes(make_gradient()))
+        self.assertEqual(os.listdir(self.dir.name), ['prog.bin'])
+
+    def test_unchanged_program_keeps_file(self):
+        map_program(self.path, make_gradient)
+        os.utime(self.path, ns=(1_000_000_000, 1_000_000_000))
+        report = map_program(self.path, make_gradient)
+        self.assertTrue(report.startswith("Unchanged"))
+        self.assertEqual(os.stat(self.path).st_mtime_ns, 1_000_000_000)
+        self.assertEqual(os.listdir(self.dir.name), ['prog.bin'])
+
+    def test_failed_generation_keeps_previous_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'old')
+        def bad(e):
+            e.movi(0, 1)
+            raise RuntimeError("boom")
+        with self.assertRaises(RuntimeError):
+            map_program(self.path, bad)
+        self.assertEqual(self.read(), b'old')
+        self.assertEqual(os.listdir(self.dir.name), ['prog.bin'])
+
+    def test_program_larger_than_mapping_raises(self):
+        def huge(e):
+            for _ in range(MAX_PROGRAM // 4 + 1):
+                e.movi(0, 1)
+            return e.finalize()
+        with self.assertRaises(ValueError):
+            map_program(self.path, huge)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()